@@ -0,0 +1,93 @@
+# fptokens benchmark: TemplateSet vs. matching each template in turn
+from __future__ import print_function
+
+import random
+import timeit
+
+import fptokens as fpt
+
+
+def distinct_folders(idx):
+    # every template has its own literal folder
+    return fpt.Filename(root='/projects',
+                        folders=['show{0}'.format(idx % 25),
+                                 '$shot$', 'pass{0}'.format(idx)],
+                        base=['$shot$', 'pass{0}'.format(idx), '$frame$'],
+                        extension='exr')
+
+
+def shared_folders(idx):
+    # all templates share their folders and differ in the basename only
+    return fpt.Filename(root='/projects',
+                        folders=['show', '$shot$', 'renders'],
+                        base=['$shot$', 'pass{0}'.format(idx), '$frame$'],
+                        extension='exr')
+
+
+def token_names(idx):
+    # all templates share their structure and differ in token names and
+    # extension only
+    return fpt.Filename(root='/projects',
+                        folders=['$show{0}$'.format(idx),
+                                 '$shot{0}$'.format(idx)],
+                        base=['$shot{0}$'.format(idx),
+                              '$frame{0}$'.format(idx)],
+                        extension='e{0}'.format(idx))
+
+
+PATHS = {
+    distinct_folders: '/projects/show{3}/sh{0:03d}/pass{2}/'
+                      'sh{0:03d}_pass{2}_{1:04d}.exr',
+    shared_folders: '/projects/show/sh{0:03d}/renders/'
+                    'sh{0:03d}_pass{2}_{1:04d}.exr',
+    token_names: '/projects/show/sh{0:03d}/sh{0:03d}_{1:04d}.e{2}',
+}
+
+
+def templates(factory, count):
+    result = []
+    for idx in range(count):
+        fp = factory(idx)
+        fp.parse()
+        result.append(fp)
+    return result
+
+
+def paths(factory, count, number=1000):
+    rng = random.Random(count)
+    return [PATHS[factory].format(rng.randint(0, 999), rng.randint(0, 9999),
+                                  idx, idx % 25)
+            for idx in (rng.randrange(count) for _ in range(number))]
+
+
+def sequential(filenames, path):
+    for fp in filenames:
+        values = fp.match(path)
+        if values is not None:
+            return fp, values
+    return None
+
+
+def main():
+    print('{0:>18} {1:>10} {2:>16} {3:>16}'.format(
+        'case', 'templates', 'TemplateSet', 'sequential'))
+    for factory in (distinct_folders, shared_folders, token_names):
+        for count in (10, 100, 1000):
+            filenames = templates(factory, count)
+            template_set = fpt.TemplateSet(filenames)
+            samples = paths(factory, count)
+            for path in samples:
+                assert template_set.match(path) == \
+                    sequential(filenames, path)
+            fast = min(timeit.repeat(
+                lambda: [template_set.match(path) for path in samples],
+                number=1, repeat=5)) / len(samples)
+            slow = min(timeit.repeat(
+                lambda: [sequential(filenames, path) for path in samples],
+                number=1, repeat=3)) / len(samples)
+            print('{0:>18} {1:>10} {2:>13.1f} us {3:>13.1f} us'.format(
+                factory.__name__, count, fast * 1e6, slow * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,36 @@
 import os
 import re
+import sys
 import attr
+import math
+import json
+import errno
+import hashlib
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import warnings
 
-from copy import deepcopy
+from copy import copy
 from itertools import product
+from multiprocessing.pool import ThreadPool
 
 from path import Path
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 __version__ = '0.1.1'
 __all__ = []
 
+NAME_MAX = 255
+PATH_MAX = 4096
+FORBIDDEN = '\0' + os.path.sep + (os.path.altsep or '')
+
 
 class TokenError(ValueError):
     """
@@ -95,10 +116,13 @@ class Token(object):
 @attr.s(cmp=False, hash=False, repr=False)
 class Filename(object):
     """
-    Filenames with support for tokens.
+    Filenames with support for tokens. Permutations can be spread over
+    several root locations, each permutation is placed on the root chosen by
+    weighted rendezvous hashing of its token values, see :meth:`locate`.
 
-    :param root: Root location
-    :type root: str
+    :param root: Root location or list of root locations, each optionally
+                 given as a ``(root, weight)`` tuple
+    :type root: str or list
     :param folders: Folder names, attribute supports tokens
     :type folders: list of str
     :param base: Basename of the file, attribute supports tokens
@@ -122,12 +146,14 @@ class Filename(object):
     escape = attr.ib(default='$')
 
     def __attrs_post_init__(self):
-        self._root = Path(self._root)
+        self.roots = self._root
+        self._values = {}
 
     @property
     def root(self):
         """
-        Return the filename's root location.
+        Return the filename's root location, the first one if the filename
+        has several root locations.
 
         :return: Root location
         :rtype: :class:`~path.Path`
@@ -143,17 +169,60 @@ class Filename(object):
         :param value: New root location
         :type value: str
         """
-        self._root = Path(value)
+        self.roots = [value]
+
+    @property
+    def roots(self):
+        """
+        Return the filename's root locations and their weights.
+
+        :return: List of ``(root, weight)`` tuples
+        :rtype: list
+        """
+        return list(self._roots)
+
+    @roots.setter
+    def roots(self, value):
+        """
+        Given a ``value``, convert each root location to a
+        :class:`~path.Path` with a weight, default: ``1.0``, and set the
+        filename's root locations.
+
+        :param value: New root location or list of root locations, each
+                      optionally given as a ``(root, weight)`` tuple
+        :type value: str or list
+        """
+        if not isinstance(value, list):
+            value = [value]
+        if not value:
+            raise ValueError('At least one root location required')
+        roots = []
+        for root in value:
+            weight = 1.0
+            if isinstance(root, tuple):
+                root, weight = root
+            if weight <= 0:
+                raise ValueError('Root weights must be positive')
+            roots.append((Path(root), float(weight)))
+        self._roots = roots
+        self._root = roots[0][0]
+        self._root_seeds = [(root, weight, _to_bytes(root))
+                            for root, weight in roots]
 
     @property
     def dirname(self):
         """
-        Return the filename's location.
+        Return the filename's location. If the filename has several root
+        locations and no open tokens, the location is below the root
+        location returned by :meth:`~fptokens.Filename.locate`.
 
         :return: Dirname
         :rtype: str
         """
-        return self.root / os.path.sep.join(
+        root = self.root
+        if len(self._root_seeds) > 1 and not self.tokens:
+            root = self.locate()
+        return root / os.path.sep.join(
             [str(folder) for folder in self.folders])
 
     @property
@@ -182,6 +251,38 @@ class Filename(object):
                         if isinstance(token, Token)])
         return [token for token in folders.union(basename)]
 
+    def locate(self, **kwargs):
+        r"""
+        Given a value for each token as \**kwargs, return the root location
+        of the permutation without accessing the filesystem. Each root
+        location is scored by a hash of its path and the token values,
+        scaled by its weight, and the highest score wins. Adding a root
+        location only moves the permutations that it wins. Raise
+        :class:`~fptokens.TokenError` if the data provided does not match the
+        tokens.
+
+        :params \**kwargs: Token values
+        :return: Root location
+        :rtype: :class:`~path.Path`
+        """
+        if len(self._root_seeds) == 1:
+            return self._root
+        values = dict(self._values)
+        values.update(kwargs)
+        names = sorted(set([token.name for token in self.tokens] +
+                           list(self._values)))
+        for name in names:
+            if name not in values:
+                raise TokenError('Data missing for token {0}'.format(name))
+        key = b'\0'.join([_to_bytes(values[name]) for name in names])
+        best, best_score = None, None
+        for root, weight, seed in self._root_seeds:
+            digest = hashlib.md5(seed + b'\0' + key).hexdigest()
+            score = weight / -math.log((int(digest[:16], 16) + 0.5) / 2 ** 64)
+            if best_score is None or score > best_score:
+                best, best_score = root, score
+        return best
+
     @property
     def abspath(self):
         """
@@ -218,36 +319,498 @@ class Filename(object):
                     base_components[component_idx] = Token(name=token,
                                                            escape=self.escape)
 
-    def _replace_tokens(self, permutation, permutation_fp):
+    @property
+    def bound(self):
+        """
+        Return the token values bound with :meth:`bind`.
+
+        :return: Token values (token_name: token_value)
+        :rtype: dict
         """
-        Given a ``permutation`` (token_name, token_value) and a
-        ``permutation_fp``, replace all matching tokens with permutation values
-        and return the resulting :class:`~fptokens.Filename`.
+        return dict(self._values)
 
-        :param permutation: Permutation (token_name, token_value)
-        :type permutation: tuple
-        :permutation_fp: :class:`~fptokens.Filename`, tokenised
-        :type permutation_fp: :class:`~fptokens.Filename`
+    def _bind(self, values):
+        """
+        Given a set of token ``values``, return a new
+        :class:`~fptokens.Filename` with the matching tokens replaced. The
+        new filename shares its tokens and root locations with this one,
+        only the ``folders`` and ``base`` lists are copied. Values without a
+        matching token are ignored.
+
+        :param values: Token values (token_name: token_value)
+        :type values: dict
         :return: :class:`~fptokens.Filename` with replaced tokens
         :rtype: :class:`~fptokens.Filename`
         """
-        for components in (permutation_fp.folders, permutation_fp.base):
-            for comp_idx, comp in enumerate(components):
-                if isinstance(comp, Token):
-                    for token_name, token_value in permutation:
-                        if comp.name == token_name:
-                            components[comp_idx] = token_value
-        return permutation_fp
+        def replace(component):
+            if isinstance(component, Token) and component.name in values:
+                return values[component.name]
+            return component
+        bound = copy(self)
+        bound.folders = [replace(folder) for folder in self.folders]
+        bound.base = [replace(base) for base in self.base]
+        bound._values = dict(self._values)
+        for token in self.tokens:
+            if token.name in values:
+                bound._values[token.name] = values[token.name]
+        if len(self._roots) > 1 and not bound.tokens:
+            bound.roots = [self.locate(**bound._values)]
+        return bound
+
+    def bind(self, **kwargs):
+        r"""
+        Given a value for some of the tokens as \**kwargs, return a new
+        :class:`~fptokens.Filename` with these tokens replaced and the
+        remaining tokens left open. Bound filenames share their structure
+        with the filename they were bound from and can be bound further.
+        Raise :class:`~fptokens.TokenError` if a value does not match an
+        open token.
 
-    def resolve(self, **kwargs):
+        :params \**kwargs: Token values
+        :return: Partially bound filename
+        :rtype: :class:`~fptokens.Filename`
         """
-        Given a set of \**kwargs, yield all possible permutations for the data
-        set provided. Raise :class:`~fptokens.TokenError` if
-        :class:`~fptokens.Filename` does not haven tokens or the data provided
-        does not match the tokens.
+        names = set([token.name for token in self.tokens])
+        for name in kwargs:
+            if name not in names:
+                raise TokenError('No open token {0}'.format(name))
+        return self._bind(kwargs)
+
+    def to_globs(self):
+        """
+        Return a glob pattern for each of the filename's root locations,
+        together matching all permutations of the open tokens.
+
+        :return: Glob patterns, in the order of :attr:`roots`
+        :rtype: list of str
+        """
+        def escape(component):
+            if isinstance(component, Token):
+                return '*'
+            return re.sub(r'([*?[])', r'[\1]', str(component))
+        basename = '{0}.{1}'.format(
+            self.separator.join([escape(base) for base in self.base]),
+            escape(self.extension))
+        components = [escape(folder) for folder in self.folders] + [basename]
+        return [os.path.join(escape(root), *components)
+                for root, _ in self._roots]
+
+    def to_glob(self):
+        """
+        Return a glob pattern matching all permutations of the open tokens
+        below the filename's root location. Raise :class:`ValueError` if
+        the filename has several root locations, use :meth:`to_globs`
+        instead.
+
+        :return: Glob pattern
+        :rtype: str
+        """
+        if len(self._roots) > 1:
+            raise ValueError('Several root locations, use to_globs()')
+        return self.to_globs()[0]
+
+    def to_regex(self):
+        """
+        Return a regular expression matching all permutations of the open
+        tokens below the filename's root locations. Its ``match()`` method
+        returns the values of the open tokens (token_name: token_value) or
+        ``None``, the compiled expression is available as ``pattern``.
+
+        :return: Regular expression
+        :rtype: :class:`~fptokens.TokenRegex`
+        """
+        seen = set()
+        roots = '|'.join([re.escape(os.path.join(str(root), ''))
+                          if str(root) else '' for root, _ in self._roots])
+        folders = ''.join([self._token_pattern(folder, {}, seen) +
+                           re.escape(os.path.sep)
+                           for folder in self.folders])
+        return TokenRegex(re.compile(r'(?:{0}){1}{2}\Z'.format(
+            roots, folders, self._base_regex({}, seen))))
+
+    def _token_pattern(self, component, values, seen, prefix='_'):
+        """
+        Return the regular expression for a single ``component``. Literal
+        components and tokens with a value in ``values`` match verbatim,
+        tokens seen before match through a back reference.
+
+        :param component: Component of ``folders`` or ``base``
+        :type component: str or :class:`~fptokens.Token`
+        :param values: Known token values (token_name: token_value)
+        :type values: dict
+        :param seen: Names of tokens already captured in the pattern
+        :type seen: set
+        :param prefix: Prefix of the capture group names, default: ``_``
+        :type prefix: str
+        :return: Regular expression
+        :rtype: str
+        """
+        if not isinstance(component, Token):
+            return re.escape(str(component))
+        if component.name in values:
+            return re.escape(values[component.name])
+        if component.name in seen:
+            return '(?P={0}{1})'.format(prefix, component.name)
+        seen.add(component.name)
+        return '(?P<{0}{1}>[^{2}]+?)'.format(prefix, component.name,
+                                             re.escape(os.path.sep))
+
+    def _base_regex(self, values, seen, prefix='_'):
+        """
+        Return the regular expression matching the filename's basename,
+        given the token ``values`` known from ``folders``.
+
+        :param values: Known token values (token_name: token_value)
+        :type values: dict
+        :param seen: Names of tokens already captured in the pattern
+        :type seen: set
+        :param prefix: Prefix of the capture group names, default: ``_``
+        :type prefix: str
+        :return: Regular expression
+        :rtype: str
+        """
+        pattern = re.escape(self.separator).join(
+            [self._token_pattern(base, values, seen, prefix)
+             for base in self.base])
+        return r'{0}\.{1}'.format(pattern, re.escape(self.extension))
+
+    def _base_pattern(self, values):
+        """
+        Return the compiled regular expression matching the filename's
+        basename, given the token ``values`` known from ``folders``.
+
+        :param values: Known token values (token_name: token_value)
+        :type values: dict
+        :return: Compiled regular expression
+        :rtype: :class:`re.RegexObject`
+        """
+        return re.compile(self._base_regex(values, set()) + r'\Z')
+
+    def _match_child(self, depth, values, name):
+        """
+        Given the ``depth`` of a directory below the root location and the
+        token ``values`` collected on the way there, match the entry ``name``
+        against the corresponding component. Return the updated token values
+        or ``None`` if ``name`` does not match.
+
+        :param depth: Directory depth below the root location
+        :type depth: int
+        :param values: Token values (token_name: token_value)
+        :type values: dict
+        :param name: Directory entry name
+        :type name: str
+        :return: Token values or ``None``
+        :rtype: dict
+        """
+        if depth == len(self.folders):
+            match = self._base_pattern(values).match(name)
+            if not match:
+                return None
+            values = dict(values)
+            for group, value in match.groupdict().items():
+                values[group[1:]] = value
+            return values
+        folder = self.folders[depth]
+        if not isinstance(folder, Token):
+            return values if name == str(folder) else None
+        if values.get(folder.name, name) != name:
+            return None
+        values = dict(values)
+        values[folder.name] = name
+        return values
+
+    def _walk(self, dirpath=None, depth=0, values=None, visit=None):
+        """
+        Walk the filename's root location, following only directories that
+        match ``folders``, and yield a ``(dirpath, depth, values, matches)``
+        tuple for every visited directory. ``matches`` is a list of
+        ``(path, values)`` tuples of the subdirectories matching ``folders``
+        or, at the deepest level, of the entries matching ``base``.
+
+        :param dirpath: Directory to start at, default: root location
+        :type dirpath: str
+        :param depth: Depth of ``dirpath`` below the root location
+        :type depth: int
+        :param values: Known token values (token_name: token_value)
+        :type values: dict
+        :param visit: Callable receiving each directory before it is listed,
+                      the directory is skipped if it returns ``False``
+        :type visit: callable
+        """
+        values = dict(self._values, **(values or {}))
+        if dirpath is None:
+            stack = [(str(root), depth, values)
+                     for root, _ in reversed(self._roots)]
+        else:
+            stack = [(dirpath, depth, values)]
+        while stack:
+            dirpath, depth, values = stack.pop()
+            if visit is not None and not visit(dirpath):
+                continue
+            folder = (self.folders[depth]
+                      if depth < len(self.folders) else None)
+            if folder is not None and not isinstance(folder, Token):
+                names = [str(folder)]
+            else:
+                try:
+                    names = os.listdir(dirpath or os.curdir)
+                except OSError:
+                    continue
+            matches = []
+            for name in names:
+                child_values = self._match_child(depth, values, name)
+                if child_values is None:
+                    continue
+                path = os.path.join(dirpath, name)
+                if folder is None or os.path.isdir(path):
+                    matches.append((path, child_values))
+            yield dirpath, depth, values, matches
+            if folder is not None:
+                stack.extend([(path, depth + 1, child_values)
+                              for path, child_values in reversed(matches)])
+
+    def _render_path(self, values):
+        """
+        Given a full set of token ``values``, return the path of the
+        corresponding permutation without creating intermediate
+        :class:`~fptokens.Filename` objects.
+
+        :param values: Token values (token_name: token_value)
+        :type values: dict
+        :return: Path
+        :rtype: str
+        """
+        def render(component):
+            if isinstance(component, Token):
+                return values[component.name]
+            return str(component)
+        basename = '{0}.{1}'.format(
+            self.separator.join([render(base) for base in self.base]),
+            self.extension)
+        return os.path.join(str(self.locate(**values)),
+                            *([render(folder) for folder in self.folders] +
+                              [basename]))
+
+    def match(self, path):
+        """
+        Given a ``path``, return the token values it was rendered from or
+        ``None`` if it does not match the filename.
+
+        :param path: Path relative to the current directory or absolute
+        :type path: str
+        :return: Token values (token_name: token_value) or ``None``
+        :rtype: dict
+        """
+        path = os.path.normpath(str(path))
+        for root, _ in self._roots:
+            root = os.path.normpath(str(root) or os.curdir)
+            names = os.path.relpath(path, root).split(os.path.sep)
+            if (len(names) != len(self.folders) + 1 or
+                    names[0] == os.path.pardir):
+                continue
+            values = dict(self._values)
+            for depth, name in enumerate(names):
+                values = self._match_child(depth, values, name)
+                if values is None:
+                    break
+            if values is not None:
+                return values
+        return None
+
+    def scan(self):
+        """
+        Yield a ``(path, values)`` tuple for every existing file below the
+        root location that matches the filename. Only directories matching
+        ``folders`` are visited.
+
+        :return: Generator of ``(path, values)`` tuples
+        :rtype: generator
+        """
+        for _, depth, _, matches in self._walk():
+            if depth < len(self.folders):
+                continue
+            for path, values in matches:
+                yield path, values
+
+    def watch(self, interval=1.0, inotify=True):
+        """
+        Return a started :class:`~fptokens.ExistenceIndex` keeping track of
+        the existing permutations of the filename.
+
+        :param interval: Polling interval in seconds, default: ``1.0``
+        :type interval: float
+        :param inotify: Use inotify on Linux, default: ``True``
+        :type inotify: bool
+        :return: Existence index
+        :rtype: :class:`~fptokens.ExistenceIndex`
+        """
+        index = ExistenceIndex(self, interval=interval, inotify=inotify)
+        index.start()
+        return index
+
+    def validate(self, forbidden=FORBIDDEN, name_max=NAME_MAX,
+                 path_max=PATH_MAX, **kwargs):
+        r"""
+        Given a set of \**kwargs, check each token value once against the
+        components it fills and raise :class:`~fptokens.TokenError` listing
+        all offending values. Values must not be empty or contain
+        ``forbidden`` characters and folder names must not exceed
+        ``name_max`` bytes. The basename and full path are checked for the
+        worst case, built from the longest value of each token, against
+        ``name_max`` and ``path_max`` bytes.
+
+        :param forbidden: Forbidden characters, default: ``NUL`` and the
+                          path separators
+        :type forbidden: str
+        :param name_max: Maximum component length, default: ``255``
+        :type name_max: int
+        :param path_max: Maximum path length, default: ``4096``
+        :type path_max: int
+        :params \**kwargs: Permutation data
+        """
+        folder_tokens = set([folder.name for folder in self.folders
+                             if isinstance(folder, Token)])
+        errors = []
+        longest = {}
+        for token in sorted(self.tokens, key=lambda token: token.name):
+            if token.name not in kwargs:
+                raise TokenError('Data missing for token {0}'.format(token))
+            token_data = kwargs[token.name]
+            if callable(token_data):
+                token_data = token_data()
+            elif iter(token_data) is token_data:
+                raise TokenError('Streamed data for token {0} can not be '
+                                 'validated'.format(token))
+            for value in token_data:
+                value = str(value)
+                length = len(_to_bytes(value))
+                if not value:
+                    errors.append('{0}: empty value'.format(token.name))
+                    continue
+                chars = sorted(set([char for char in value
+                                    if char in forbidden]))
+                if chars:
+                    errors.append('{0}: {1!r} contains {2!r}'.format(
+                        token.name, value, ''.join(chars)))
+                if token.name in folder_tokens:
+                    if value in (os.curdir, os.path.pardir):
+                        errors.append('{0}: {1!r} is not a folder '
+                                      'name'.format(token.name, value))
+                    if length > name_max:
+                        errors.append('{0}: {1!r} exceeds {2} bytes'.format(
+                            token.name, value, name_max))
+                if length > longest.get(token.name, (-1, None))[0]:
+                    longest[token.name] = (length, value)
 
+        def size(component):
+            if isinstance(component, Token):
+                return longest.get(component.name, (0, None))[0]
+            return len(_to_bytes(component))
+
+        def culprits(components):
+            return ', '.join(['{0}={1!r}'.format(name, longest[name][1])
+                              for name in sorted(set(
+                                  [component.name for component in components
+                                   if isinstance(component, Token)]))
+                              if name in longest])
+
+        base_size = (sum([size(base) for base in self.base]) +
+                     len(_to_bytes(self.separator)) *
+                     max(0, len(self.base) - 1) +
+                     len(_to_bytes(self.extension)) + 1)
+        if base_size > name_max:
+            errors.append('basename of {0} bytes exceeds {1} bytes for '
+                          '{2}'.format(base_size, name_max,
+                                       culprits(self.base)))
+        root_size = max([len(_to_bytes(root)) for root, _ in self._roots])
+        path_size = (root_size + (1 if root_size else 0) +
+                     sum([size(folder) + 1 for folder in self.folders]) +
+                     base_size)
+        if path_size > path_max:
+            errors.append('path of {0} bytes exceeds {1} bytes for '
+                          '{2}'.format(path_size, path_max,
+                                       culprits(self.folders + self.base)))
+        if errors:
+            raise TokenError('Invalid data: {0}'.format('; '.join(errors)))
+
+    def materialize(self, source, mode='hardlink', jobs=8, batch_size=256,
+                    callback=None, **kwargs):
+        r"""
+        Given a ``source`` file and a set of \**kwargs, place the file at the
+        path of every permutation for the data set provided. Permutations
+        are streamed in batches of consecutive files sharing a folder, each
+        folder is created the first time it is seen, and the batches are
+        linked or copied in parallel relative to an open descriptor of their
+        folder. Only the set of folders is kept in memory. Existing files are
+        skipped, an interrupted run is resumed by running it again.
+
+        ``hardlink`` links the permutations to ``source`` and copies it to
+        root locations on another filesystem, ``reflink`` clones it on
+        filesystems supporting copy-on-write and copies it otherwise,
+        ``copy`` copies it in the kernel with :func:`os.copy_file_range` or
+        :func:`os.sendfile` where available.
+
+        :param source: Source file
+        :type source: str
+        :param mode: ``hardlink``, ``reflink`` or ``copy``,
+                     default: ``hardlink``
+        :type mode: str
+        :param jobs: Number of parallel threads, default: ``8``
+        :type jobs: int
+        :param batch_size: Number of files per batch, default: ``256``
+        :type batch_size: int
+        :param callback: Callable receiving each created path, called from
+                         the worker threads, default: ``None``
+        :type callback: callable
         :params \**kwargs: Permutation data
+        :return: Number of created files
+        :rtype: int
+        """
+        if mode not in ('hardlink', 'reflink', 'copy'):
+            raise ValueError('mode must be hardlink, reflink or copy')
+        source = os.path.abspath(str(source))
+        counts = []
+
+        def batches():
+            folders = set()
+            dirpath, basenames = None, []
+            for permutation in self._permutations(kwargs):
+                path = self._render_path(dict(permutation))
+                folder, basename = os.path.split(path)
+                if basenames and (folder != dirpath or
+                                  len(basenames) >= batch_size):
+                    yield source, mode, dirpath, basenames
+                    basenames = []
+                if folder not in folders:
+                    Path(folder).makedirs_p()
+                    folders.add(folder)
+                dirpath = folder
+                basenames.append(basename)
+            if basenames:
+                yield source, mode, dirpath, basenames
+
+        def work(batch):
+            created = _materialize_batch(batch)
+            counts.append(len(created))
+            if callback is not None:
+                for path in created:
+                    callback(path)
+
+        consume(batches(), work, jobs=jobs, maxsize=2 * max(1, jobs))
+        return sum(counts)
+
+    def _permutations(self, kwargs, on_duplicate=None, case_sensitive=True,
+                      max_exact=1000000, error_rate=0.001, validate=False):
         """
+        Given a set of permutation data ``kwargs``, check it and yield all
+        permutations (token_name, token_value) for the data set provided.
+        See :meth:`resolve` for the remaining parameters.
+
+        :param kwargs: Permutation data
+        :type kwargs: dict
+        """
+        if on_duplicate not in (None, 'error', 'skip'):
+            raise ValueError('on_duplicate must be error, skip or None')
         if not self.tokens:
             raise TokenError('Tokens required for resolve()')
         tokens = self.tokens[:]
@@ -255,14 +818,93 @@ class Filename(object):
             token = tokens.pop()
             if token.name not in kwargs:
                 raise TokenError('Data missing for token {0}'.format(token))
-        perm_data = []
-        for token_name, token_data in kwargs.iteritems():
-            perm_data.append([(token_name, data) for data in token_data])
-        for permutation in product(*perm_data):
-            yield self._replace_tokens(permutation, deepcopy(self))
+        if validate:
+            self.validate(**kwargs)
+        dimensions, streamed, capacity = [], None, 1
+        for token_name, token_data in kwargs.items():
+            if callable(token_data):
+                dimensions.append((token_name, token_data))
+                capacity = None
+            elif iter(token_data) is token_data:
+                if streamed is not None:
+                    raise TokenError('Only one token can be streamed, got '
+                                     '{0} and {1}'.format(streamed[0],
+                                                          token_name))
+                streamed = (token_name, token_data)
+                capacity = None
+            else:
+                dimensions.append((token_name,
+                                   lambda token_data=token_data: token_data))
+                try:
+                    capacity *= len(token_data)
+                except TypeError:
+                    capacity = None
+        if streamed is not None:
+            dimensions.insert(0, (streamed[0], lambda: streamed[1]))
+        paths = None
+        if on_duplicate is not None:
+            paths = _PathSet(max_exact=max_exact, error_rate=error_rate,
+                             capacity=capacity)
+        for permutation in _lazy_product(dimensions):
+            if paths is not None:
+                path = self._render_path(dict(permutation))
+                if not case_sensitive:
+                    path = path.lower()
+                if paths.add(path):
+                    if on_duplicate == 'error':
+                        raise TokenError('Duplicate path {0}'.format(path))
+                    continue
+            yield permutation
+
+    def resolve(self, on_duplicate=None, case_sensitive=True,
+                max_exact=1000000, error_rate=0.001, validate=False,
+                **kwargs):
+        r"""
+        Given a set of \**kwargs, yield all possible permutations for the data
+        set provided, each placed on the root location returned by
+        :meth:`locate`. Raise :class:`~fptokens.TokenError` if
+        :class:`~fptokens.Filename` does not haven tokens or the data provided
+        does not match the tokens.
+
+        Besides lists, the data of a token can be a callable returning a new
+        iterable each time, which is called again for every combination of
+        the tokens before it, or, for at most one token, an iterator, which
+        is consumed once as the outermost loop. Neither is read into memory
+        up front.
+
+        Permutations rendering to a path that was yielded before are detected
+        if ``on_duplicate`` is set: ``error`` raises
+        :class:`~fptokens.TokenError`, ``skip`` drops the permutation. The
+        first ``max_exact`` paths are remembered exactly, beyond that a Bloom
+        filter is used that grows with the number of paths and keeps the
+        false positive rate below ``error_rate``. It may report a unique path
+        as a duplicate.
+
+        If ``validate`` is set, the data is checked with :meth:`validate`
+        before the first permutation is yielded.
+
+        :param on_duplicate: ``error``, ``skip`` or ``None``, default: ``None``
+        :type on_duplicate: str
+        :param case_sensitive: Compare paths case sensitively,
+                               default: ``True``
+        :type case_sensitive: bool
+        :param max_exact: Number of paths remembered exactly,
+                          default: ``1000000``
+        :type max_exact: int
+        :param error_rate: False positive rate of the Bloom filter,
+                           default: ``0.001``
+        :type error_rate: float
+        :param validate: Validate the data up front, default: ``False``
+        :type validate: bool
+        :params \**kwargs: Permutation data
+        """
+        for permutation in self._permutations(kwargs, on_duplicate,
+                                              case_sensitive, max_exact,
+                                              error_rate, validate):
+            yield self._bind(dict(permutation))
 
     def __key(self):
-        return (self.root, self.folders, self.basename,
+        return (self._roots, self.folders, self.basename,
                 self.separator, self.extension)
 
     def __eq__(self, other):
@@ -278,3 +920,1167 @@ class Filename(object):
 
     def __repr__(self):
         return '<Filename: {0}>'.format(self.abspath)
+
+
+def _lazy_product(dimensions):
+    """
+    Given a list of ``(token_name, source)`` tuples, yield the cartesian
+    product of the values returned by the sources as tuples of
+    (token_name, token_value). Unlike :func:`itertools.product`, the values
+    are not read up front, each source is called again whenever the
+    dimensions before it advance.
+
+    :param dimensions: List of ``(token_name, source)`` tuples, ``source``
+                       being a callable returning an iterable
+    :type dimensions: list
+    """
+    if not dimensions:
+        yield ()
+        return
+    iterators = [iter(dimensions[0][1]())]
+    permutation = []
+    while iterators:
+        try:
+            value = next(iterators[-1])
+        except StopIteration:
+            iterators.pop()
+            if permutation:
+                permutation.pop()
+            continue
+        permutation.append((dimensions[len(permutation)][0], value))
+        if len(permutation) == len(dimensions):
+            yield tuple(permutation)
+            permutation.pop()
+        else:
+            iterators.append(iter(dimensions[len(permutation)][1]()))
+
+
+def _to_bytes(value):
+    """
+    Return ``value`` as UTF-8 encoded bytes.
+
+    :param value: Value
+    :type value: str
+    :return: Encoded value
+    :rtype: bytes
+    """
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u'')):
+        value = str(value)
+        if isinstance(value, bytes):
+            return value
+    return value.encode('utf-8')
+
+
+class _BloomFilter(object):
+    """
+    Bloom filter for ``capacity`` items at a false positive rate of
+    ``error_rate``, addressed by the two hashes of each item.
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.count = 0
+        self._size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._hashes = max(1, int(round(
+            float(self._size) / capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, first, second):
+        return [(first + idx * second) % self._size
+                for idx in range(self._hashes)]
+
+    def __contains__(self, hashes):
+        for position in self._positions(*hashes):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, hashes):
+        for position in self._positions(*hashes):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+
+class _PathSet(object):
+    """
+    Set of paths for duplicate detection with bounded memory. The first
+    ``max_exact`` paths are stored in a :class:`set`, after that all paths
+    move into a scalable Bloom filter: a chain of filters starting at
+    ``capacity`` paths, each one twice as large as the one before, with
+    false positive rates shrinking so that the chain as a whole stays below
+    ``error_rate``.
+    """
+    growth = 2
+    tightening = 0.5
+
+    def __init__(self, max_exact=1000000, error_rate=0.001, capacity=None):
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+        self.max_exact = max_exact
+        self.error_rate = error_rate
+        self.capacity = max(capacity or 0, 2 * max_exact, 1)
+        self._exact = set()
+        self._filters = None
+
+    @staticmethod
+    def _hashes(path):
+        digest = hashlib.md5(_to_bytes(path)).hexdigest()
+        return int(digest[:16], 16), int(digest[16:], 16) | 1
+
+    def _grow(self):
+        if not self._filters:
+            capacity = self.capacity
+            error_rate = self.error_rate * (1 - self.tightening)
+        else:
+            capacity = self._filters[-1].capacity * self.growth
+            error_rate = self._error_rate * self.tightening
+        self._error_rate = error_rate
+        self._filters.append(_BloomFilter(capacity, error_rate))
+
+    def _to_bloom(self):
+        exact, self._exact = self._exact, None
+        self._filters = []
+        self._grow()
+        for path in exact:
+            self.add(path)
+
+    def add(self, path):
+        """
+        Add ``path`` to the set and return whether it was (probably) added
+        before.
+        """
+        if self._filters is None:
+            if path in self._exact:
+                return True
+            if len(self._exact) < self.max_exact:
+                self._exact.add(path)
+                return False
+            self._to_bloom()
+        hashes = self._hashes(path)
+        for bloom in self._filters:
+            if hashes in bloom:
+                return True
+        if self._filters[-1].full:
+            self._grow()
+        self._filters[-1].add(hashes)
+        return False
+
+
+class TokenRegex(object):
+    """
+    Regular expression returned by :meth:`~fptokens.Filename.to_regex`.
+    Capture groups are named after the tokens with a leading underscore,
+    as group names must not start with a digit.
+
+    :param pattern: Compiled regular expression
+    :type pattern: :class:`re.RegexObject`
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __repr__(self):
+        return '<TokenRegex: {0}>'.format(self.pattern.pattern)
+
+    def match(self, path):
+        """
+        Given a ``path``, return the values of the open tokens it was
+        rendered from or ``None`` if it does not match.
+
+        :param path: Path
+        :type path: str
+        :return: Token values (token_name: token_value) or ``None``
+        :rtype: dict
+        """
+        match = self.pattern.match(str(path))
+        if not match:
+            return None
+        return dict([(group[1:], value)
+                     for group, value in match.groupdict().items()])
+
+
+def _split_path(path):
+    """
+    Split a normalised ``path`` into its components.
+
+    :param path: Path
+    :type path: str
+    :return: Path components
+    :rtype: list
+    """
+    path = os.path.normpath(str(path))
+    if path == os.curdir:
+        return []
+    return path.split(os.path.sep)
+
+
+class _TemplateNode(object):
+    """
+    Node of the :class:`~fptokens.TemplateSet` trie. Literal folders are
+    stored in ``children``, token folders of any name share the single
+    ``wildcard`` child. The templates ending at a node are bucketed by the
+    first literal component of their basename or, if there is none, by
+    their extension.
+    """
+    # Python 2 limits a regular expression to 100 groups
+    max_groups = 99 if sys.version_info[0] < 3 else None
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.templates = []
+        self.separators = set()
+        self._buckets = {}
+        self._patterns = {}
+
+    def add(self, index, template, offset):
+        """
+        Add ``template``, whose folders start at the path component
+        ``offset``, as the ``index``-th template of the set.
+        """
+        folders = [(offset + idx, folder.name)
+                   for idx, folder in enumerate(template.folders)
+                   if isinstance(folder, Token)]
+        entry = (index, template, folders)
+        self.templates.append(entry)
+        key = ('.', template.extension)
+        for base in template.base[:-1]:
+            if (not isinstance(base, Token) and str(base) and
+                    template.separator not in str(base)):
+                key = (template.separator, str(base))
+                self.separators.add(template.separator)
+                break
+        self._buckets.setdefault(key, []).append(entry)
+        self._patterns.pop(key, None)
+
+    def patterns(self, name):
+        """
+        Given a basename ``name``, return a list of ``(regex, templates)``
+        tuples for the buckets it may belong to, each regex being an
+        alternation of the basenames of the templates in the bucket.
+        """
+        parts = name.split('.')
+        keys = [('.', '.'.join(parts[idx:])) for idx in range(1, len(parts))]
+        for separator in self.separators:
+            keys.extend([(separator, part)
+                         for part in name.split(separator)[:-1]])
+        patterns = []
+        for key in keys:
+            if key not in self._buckets:
+                continue
+            if key not in self._patterns:
+                self._patterns[key] = self._compile(self._buckets[key])
+            patterns.extend(self._patterns[key])
+        return patterns
+
+    def _compile(self, entries):
+        patterns = []
+        chunk, groups = [], 0
+        for index, template, folders in entries:
+            seen = set()
+            regex = template._base_regex({}, seen,
+                                         prefix='_{0}_'.format(index))
+            if (chunk and self.max_groups is not None and
+                    groups + len(seen) + 1 > self.max_groups):
+                patterns.append(self._alternation(chunk))
+                chunk, groups = [], 0
+            chunk.append((index, template, folders, regex, sorted(seen)))
+            groups += len(seen) + 1
+        if chunk:
+            patterns.append(self._alternation(chunk))
+        return patterns
+
+    @staticmethod
+    def _alternation(chunk):
+        regex = '|'.join(['(?P<_{0}>{1})'.format(entry[0], entry[3])
+                          for entry in chunk])
+        templates = dict([('_{0}'.format(entry[0]), entry)
+                          for entry in chunk])
+        return re.compile(r'(?:{0})\Z'.format(regex)), templates
+
+
+@attr.s(cmp=False, hash=False, repr=False)
+class TemplateSet(object):
+    """
+    Collection of tokenised :class:`~fptokens.Filename` objects that
+    classifies paths by the template they were rendered from. Literal
+    components of the root locations and folders are stored in a prefix
+    trie, token folders share one wildcard branch per position. The
+    templates ending at a trie node are bucketed by a literal component of
+    their basename and the basenames of each bucket are combined into a
+    single alternation, so matching a path does not try each template in
+    turn. If several templates match, the one added first wins.
+
+    :param templates: Tokenised filenames
+    :type templates: list of :class:`~fptokens.Filename`
+    """
+    templates = attr.ib(default=attr.Factory(list),
+                        validator=attr.validators.instance_of(list))
+
+    def __attrs_post_init__(self):
+        self._trie = _TemplateNode()
+        templates, self.templates = self.templates, []
+        for template in templates:
+            self.add(template)
+
+    def add(self, template):
+        """
+        Add a tokenised ``template`` to the set.
+
+        :param template: Tokenised filename
+        :type template: :class:`~fptokens.Filename`
+        """
+        for root, _ in template.roots:
+            node = self._trie
+            names = _split_path(root)
+            for name in names:
+                node = node.children.setdefault(name, _TemplateNode())
+            for folder in template.folders:
+                if isinstance(folder, Token):
+                    if node.wildcard is None:
+                        node.wildcard = _TemplateNode()
+                    node = node.wildcard
+                else:
+                    node = node.children.setdefault(str(folder),
+                                                    _TemplateNode())
+            node.add(len(self.templates), template, len(names))
+        self.templates.append(template)
+
+    def _candidates(self, names):
+        """
+        Given the folder ``names`` of a path, return all trie nodes reached
+        by them.
+        """
+        nodes = [self._trie]
+        for name in names:
+            reached = []
+            for node in nodes:
+                child = node.children.get(name)
+                if child is not None:
+                    reached.append(child)
+                if node.wildcard is not None:
+                    reached.append(node.wildcard)
+            nodes = reached
+            if not nodes:
+                break
+        return nodes
+
+    @staticmethod
+    def _folder_values(folders, names):
+        """
+        Given the ``(position, token_name)`` tuples of a template's token
+        folders, return their values taken from the path ``names`` or
+        ``None`` if a token repeats with different values.
+        """
+        values = {}
+        for position, token_name in folders:
+            if values.setdefault(token_name, names[position]) != \
+                    names[position]:
+                return None
+        return values
+
+    def match(self, path):
+        """
+        Given a ``path``, return a ``(template, values)`` tuple of the
+        template it matches and the token values it was rendered from or
+        ``None`` if it matches none of the templates.
+
+        :param path: Path
+        :type path: str
+        :return: ``(template, values)`` or ``None``
+        :rtype: tuple
+        """
+        names = _split_path(path)
+        if not names:
+            return None
+        best = None
+        for node in self._candidates(names[:-1]):
+            for pattern, templates in node.patterns(names[-1]):
+                match = pattern.match(names[-1])
+                if match is None:
+                    continue
+                index, template, folders, _, tokens = \
+                    templates[match.lastgroup]
+                if best is not None and best[0] < index:
+                    continue
+                result = self._folder_values(folders, names)
+                for token_name in tokens:
+                    if result is None:
+                        break
+                    value = match.group('{0}_{1}'.format(match.lastgroup,
+                                                         token_name))
+                    if result.setdefault(token_name, value) != value:
+                        result = None
+                if result is None:
+                    result = self._match_slow(node, names)
+                    if result is None:
+                        continue
+                    index, template, result = result
+                if best is None or index < best[0]:
+                    best = (index, template, result)
+        if best is None:
+            return None
+        values = dict(best[1].bound)
+        values.update(best[2])
+        return best[1], values
+
+    def _match_slow(self, node, names):
+        """
+        Match the path ``names`` against each template of ``node`` in turn,
+        used if the alternation matched a template whose folder and
+        basename values disagree.
+        """
+        for index, template, folders in node.templates:
+            values = self._folder_values(folders, names)
+            if values is None:
+                continue
+            result = template._match_child(len(template.folders), values,
+                                           names[-1])
+            if result is not None:
+                return index, template, result
+        return None
+
+    def __len__(self):
+        return len(self.templates)
+
+    def __iter__(self):
+        return iter(self.templates)
+
+    def __repr__(self):
+        return '<TemplateSet: {0} templates>'.format(len(self))
+
+
+class _Inotify(object):
+    """
+    Minimal :mod:`ctypes` binding of the Linux inotify API, reporting
+    entries created, deleted or moved in the watched directories.
+    """
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify requires Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def add(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, self._encode(path),
+                                          self.MASK)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def remove(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=0):
+        """
+        Return a list of ``(wd, mask, name)`` tuples of the pending events,
+        waiting up to ``timeout`` seconds for the first one.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return []
+            raise
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, self._decode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+    @staticmethod
+    def _encode(path):
+        if isinstance(path, bytes):
+            return path
+        return path.encode(sys.getfilesystemencoding())
+
+    @staticmethod
+    def _decode(name):
+        if isinstance(name, str):
+            return name
+        return name.decode(sys.getfilesystemencoding())
+
+
+@attr.s(cmp=False, hash=False, repr=False)
+class ExistenceIndex(object):
+    """
+    In-memory index of the existing permutations of a tokenised
+    :class:`~fptokens.Filename`. The root location is scanned once, after
+    that only the directories reported as changed are rescanned. Changes are
+    picked up from inotify on Linux and by comparing directory modification
+    times otherwise, or for directories that can not be watched. Changes
+    are applied by calling :meth:`refresh` or in a background thread between
+    :meth:`start` and :meth:`stop`.
+
+    :param filename: Tokenised filename
+    :type filename: :class:`~fptokens.Filename`
+    :param interval: Polling interval in seconds, default: ``1.0``
+    :type interval: float
+    :param inotify: Use inotify on Linux, default: ``True``
+    :type inotify: bool
+    """
+    filename = attr.ib(validator=attr.validators.instance_of(Filename))
+    interval = attr.ib(default=1.0)
+    inotify = attr.ib(default=True)
+
+    def __attrs_post_init__(self):
+        self._names = sorted([token.name for token in self.filename.tokens])
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._inotify = None
+        if self.inotify:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError):
+                self._inotify = None
+        self._scan()
+
+    @property
+    def backend(self):
+        """
+        Return the name of the change detection backend.
+
+        :return: ``inotify`` or ``poll``
+        :rtype: str
+        """
+        return 'poll' if self._inotify is None else 'inotify'
+
+    def _key(self, values):
+        return tuple([values[name] for name in self._names])
+
+    def _scan(self):
+        """Reset the index and scan the root location."""
+        with self._lock:
+            if self._inotify is not None:
+                for wd in getattr(self, '_wds', {}):
+                    self._inotify.remove(wd)
+            self._dirs = {}
+            self._files = {}
+            self._present = {}
+            self._wds = {}
+            self._unwatched = set()
+            self._add()
+
+    def _visit(self, dirpath):
+        """
+        Record the modification time of ``dirpath`` and watch it before it
+        is listed, so that no change after the listing is missed. If the
+        watch can not be added, e.g. once ``max_user_watches`` is used up,
+        the directory is polled instead.
+        """
+        try:
+            self._visited[dirpath] = self._mtime(dirpath)
+        except OSError:
+            return False
+        if self._inotify is not None:
+            try:
+                self._wds[self._inotify.add(dirpath or os.curdir)] = dirpath
+            except OSError as error:
+                if not self._unwatched:
+                    warnings.warn('Polling directories that can not be '
+                                  'watched: {0}'.format(error))
+                self._unwatched.add(dirpath)
+        return True
+
+    def _add(self, dirpath=None, depth=0, values=None):
+        """
+        Walk the filename from ``dirpath`` and add the directories and files
+        found to the index.
+        """
+        leaf = len(self.filename.folders)
+        self._visited = {}
+        for dirpath, depth, values, matches in self.filename._walk(
+                dirpath, depth, values, visit=self._visit):
+            names = set([os.path.basename(path) for path, _ in matches])
+            mtime = self._visited.pop(dirpath)
+            self._dirs[dirpath] = (depth, values, names, mtime)
+            if depth == leaf:
+                for path, file_values in matches:
+                    self._add_file(path, file_values)
+
+    def _add_file(self, path, values):
+        key = self._key(values)
+        self._files[path] = key
+        self._present[key] = path
+
+    def _remove(self, path):
+        """Remove ``path`` and everything below it from the index."""
+        key = self._files.pop(path, None)
+        if key is not None and self._present.get(key) == path:
+            del self._present[key]
+        if path not in self._dirs:
+            return
+        prefix = os.path.join(path, '')
+        for dirpath in [dirpath for dirpath in self._dirs
+                        if dirpath == path or dirpath.startswith(prefix)]:
+            del self._dirs[dirpath]
+            self._unwatched.discard(dirpath)
+        for file_path in [file_path for file_path in self._files
+                          if file_path.startswith(prefix)]:
+            key = self._files.pop(file_path)
+            if self._present.get(key) == file_path:
+                del self._present[key]
+        for wd, dirpath in list(self._wds.items()):
+            if dirpath == path or dirpath.startswith(prefix):
+                del self._wds[wd]
+                self._inotify.remove(wd)
+
+    def _update(self, dirpath, name):
+        """Update the index for the entry ``name`` of ``dirpath``."""
+        path = os.path.join(dirpath, name)
+        self._remove(path)
+        if dirpath not in self._dirs:
+            return
+        depth, values, names, mtime = self._dirs[dirpath]
+        names.discard(name)
+        child_values = self.filename._match_child(depth, values, name)
+        if child_values is None:
+            return
+        if depth == len(self.filename.folders):
+            if os.path.lexists(path):
+                names.add(name)
+                self._add_file(path, child_values)
+        elif os.path.isdir(path):
+            names.add(name)
+            self._add(path, depth + 1, child_values)
+
+    @staticmethod
+    def _mtime(dirpath):
+        stat = os.stat(dirpath or os.curdir)
+        return getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+    def _poll(self, dirpaths):
+        """Rescan the directories whose modification time changed."""
+        for dirpath in list(dirpaths):
+            if dirpath not in self._dirs:
+                continue
+            depth, values, names, mtime = self._dirs[dirpath]
+            try:
+                current = self._mtime(dirpath)
+            except OSError:
+                continue
+            if current == mtime:
+                continue
+            self._dirs[dirpath] = (depth, values, names, current)
+            try:
+                listed = set(os.listdir(dirpath or os.curdir))
+            except OSError:
+                continue
+            for name in sorted(listed.symmetric_difference(names)):
+                self._update(dirpath, name)
+
+    def _check_roots(self):
+        """
+        Add the root locations created since they were last checked and
+        remove the ones deleted, as a missing root location can not be
+        watched or polled.
+        """
+        for root, _ in self.filename._roots:
+            root = str(root)
+            if root in self._dirs:
+                if not os.path.isdir(root or os.curdir):
+                    self._remove(root)
+            elif os.path.isdir(root or os.curdir):
+                self._add(root)
+
+    def refresh(self, timeout=0):
+        """
+        Apply all pending changes to the index, waiting up to ``timeout``
+        seconds for inotify events. Root locations missing so far are
+        checked again.
+
+        :param timeout: Timeout in seconds, default: ``0``
+        :type timeout: float
+        """
+        if self._inotify is None:
+            with self._lock:
+                self._poll(self._dirs)
+                self._check_roots()
+            return
+        events = self._inotify.read(timeout)
+        pending = events
+        while pending:
+            pending = self._inotify.read()
+            events.extend(pending)
+        with self._lock:
+            for wd, mask, name in events:
+                if mask & _Inotify.IN_Q_OVERFLOW:
+                    self._scan()
+                    return
+                if mask & _Inotify.IN_IGNORED:
+                    self._wds.pop(wd, None)
+                    continue
+                dirpath = self._wds.get(wd)
+                if dirpath is not None and name:
+                    self._update(dirpath, name)
+            self._poll(self._unwatched)
+            self._check_roots()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self._inotify is None:
+                self._stopped.wait(self.interval)
+            self.refresh(self.interval)
+
+    def start(self):
+        """Keep the index up to date in a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread started by :meth:`start`."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self):
+        """Stop the background thread and release the inotify instance."""
+        self.stop()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def exists(self, **kwargs):
+        r"""
+        Given a value for each token as \**kwargs, return whether the
+        permutation exists.
+
+        :params \**kwargs: Token values
+        :return: Permutation exists
+        :rtype: bool
+        """
+        missing = [name for name in self._names if name not in kwargs]
+        if missing:
+            raise TokenError('Data missing for token {0}'.format(missing[0]))
+        with self._lock:
+            return self._key(kwargs) in self._present
+
+    def query(self, **kwargs):
+        r"""
+        Given a list of values for some of the tokens as \**kwargs, return
+        the token values of all existing permutations matching them.
+
+        :params \**kwargs: Token values to filter by
+        :return: List of token values (token_name: token_value)
+        :rtype: list of dict
+        """
+        filters = [(self._names.index(name), set(values))
+                   for name, values in kwargs.items() if name in self._names]
+        with self._lock:
+            keys = [key for key in self._present
+                    if all([key[idx] in values for idx, values in filters])]
+        return [dict(zip(self._names, key)) for key in sorted(keys)]
+
+    def missing(self, **kwargs):
+        r"""
+        Given a set of \**kwargs, return the token values of all
+        permutations of the data set that do not exist.
+
+        :params \**kwargs: Permutation data
+        :return: List of token values (token_name: token_value)
+        :rtype: list of dict
+        """
+        for name in self._names:
+            if name not in kwargs:
+                raise TokenError('Data missing for token {0}'.format(name))
+        with self._lock:
+            return [dict(zip(self._names, key)) for key in
+                    product(*[kwargs[name] for name in self._names])
+                    if key not in self._present]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._present)
+
+    def __contains__(self, values):
+        with self._lock:
+            return self._key(values) in self._present
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return '<ExistenceIndex: {0}, {1} permutations>'.format(
+            self.filename, len(self))
+
+
+# Linux ioctl cloning a file on copy-on-write filesystems, see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+_DIR_FD = (hasattr(os, 'supports_dir_fd') and os.open in os.supports_dir_fd
+           and os.link in os.supports_dir_fd)
+
+
+def _copy_fd(source_fd, target_fd, size):
+    """
+    Copy ``size`` bytes from ``source_fd`` to ``target_fd``, in the kernel
+    where possible.
+
+    :param source_fd: Source file descriptor
+    :type source_fd: int
+    :param target_fd: Target file descriptor
+    :type target_fd: int
+    :param size: Number of bytes
+    :type size: int
+    """
+    offset = 0
+    for copy in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, copy):
+            continue
+        try:
+            while offset < size:
+                if copy == 'copy_file_range':
+                    count = os.copy_file_range(source_fd, target_fd,
+                                               size - offset,
+                                               offset_src=offset)
+                else:
+                    count = os.sendfile(target_fd, source_fd, offset,
+                                        size - offset)
+                if not count:
+                    break
+                offset += count
+            return
+        except OSError as error:
+            if offset or error.errno not in (errno.EXDEV, errno.ENOSYS,
+                                             errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    os.lseek(source_fd, 0, os.SEEK_SET)
+    while True:
+        data = os.read(source_fd, 1048576)
+        if not data:
+            return
+        while data:
+            data = data[os.write(target_fd, data):]
+
+
+def _clone_fd(source_fd, target_fd):
+    """
+    Clone ``source_fd`` into ``target_fd`` and return whether the
+    filesystem supports it.
+
+    :param source_fd: Source file descriptor
+    :type source_fd: int
+    :param target_fd: Target file descriptor
+    :type target_fd: int
+    :return: File cloned
+    :rtype: bool
+    """
+    try:
+        import fcntl
+        fcntl.ioctl(target_fd, _FICLONE, source_fd)
+    except (ImportError, IOError, OSError):
+        return False
+    return True
+
+
+def _materialize_batch(batch):
+    """
+    Link or copy ``source`` to each basename of a folder and return the
+    created paths.
+
+    :param batch: ``(source, mode, dirpath, basenames)`` tuple
+    :type batch: tuple
+    :return: List of created paths
+    :rtype: list of str
+    """
+    source, mode, dirpath, basenames = batch
+    dir_fd = os.open(dirpath, os.O_RDONLY) if _DIR_FD else None
+    source_fd = None
+    created = []
+    try:
+        link = mode == 'hardlink'
+        if not link:
+            source_fd = os.open(source, os.O_RDONLY)
+            stat = os.fstat(source_fd)
+        clone = mode == 'reflink'
+        for basename in basenames:
+            path = os.path.join(dirpath, basename)
+            target = basename if _DIR_FD else path
+            open_kwargs = {'dir_fd': dir_fd} if _DIR_FD else {}
+            try:
+                if link:
+                    try:
+                        if _DIR_FD:
+                            os.link(source, target, dst_dir_fd=dir_fd)
+                        else:
+                            os.link(source, target)
+                        created.append(path)
+                        continue
+                    except OSError as error:
+                        if error.errno != errno.EXDEV:
+                            raise
+                    # the folder is on another filesystem, copy instead
+                    link = False
+                    source_fd = os.open(source, os.O_RDONLY)
+                    stat = os.fstat(source_fd)
+                target_fd = os.open(target,
+                                    os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                                    stat.st_mode & 0o777, **open_kwargs)
+            except OSError as error:
+                if error.errno == errno.EEXIST:
+                    continue
+                raise
+            try:
+                if not (clone and _clone_fd(source_fd, target_fd)):
+                    clone = False
+                    _copy_fd(source_fd, target_fd, stat.st_size)
+            except Exception:
+                os.close(target_fd)
+                os.unlink(path)
+                raise
+            os.close(target_fd)
+            created.append(path)
+    finally:
+        if source_fd is not None:
+            os.close(source_fd)
+        if dir_fd is not None:
+            os.close(dir_fd)
+    return created
+
+
+def _template_key(template):
+    """
+    Return a JSON serialisable description of ``template``, identifying
+    it in the journal of :func:`~fptokens.migrate`.
+
+    :param template: Tokenised filename
+    :type template: :class:`~fptokens.Filename`
+    :return: Template description
+    :rtype: list
+    """
+    def describe(component):
+        if isinstance(component, Token):
+            return component.token
+        return str(component)
+    return [[[str(root), weight] for root, weight in template.roots],
+            [describe(folder) for folder in template.folders],
+            [describe(base) for base in template.base],
+            template.separator, template.extension,
+            sorted([[name, str(value)]
+                    for name, value in template.bound.items()])]
+
+
+def _rename_batch(batch):
+    """
+    Rename a batch of ``(source, destination)`` paths and return the number
+    of renamed files. Raise :class:`OSError` if a destination exists.
+
+    :param batch: List of ``(source, destination)`` tuples
+    :type batch: list
+    :return: Number of renamed files
+    :rtype: int
+    """
+    for source, destination in batch:
+        if os.path.lexists(destination):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                          destination)
+        os.rename(source, destination)
+    return len(batch)
+
+
+def migrate(src_template, dst_template, dry_run=False, jobs=8,
+            batch_size=1000, progress=None, journal=None):
+    """
+    Move all existing files matching ``src_template`` to the location
+    rendered by ``dst_template`` from the same token values. Destination
+    folders are created up front and the files are renamed in parallel
+    batches with :func:`os.rename`, so source and destination must be on the
+    same filesystem. Raise :class:`~fptokens.TokenError` if
+    ``dst_template`` uses tokens that ``src_template`` does not provide. The
+    whole plan is checked before the first rename, :class:`OSError` is
+    raised if two files would move to the same destination or a destination
+    exists already.
+
+    The planned moves are appended to a ``journal`` before the first
+    rename. Files at a destination recorded in the journal are not moved
+    again, even if they match ``src_template``, so an interrupted migration
+    is resumed by running it again with the same journal. The journal is
+    tied to the pair of templates, :class:`ValueError` is raised if it
+    belongs to another migration, and removed once all files are moved.
+
+    :param src_template: Source :class:`~fptokens.Filename`, tokenised
+    :type src_template: :class:`~fptokens.Filename`
+    :param dst_template: Destination :class:`~fptokens.Filename`, tokenised
+    :type dst_template: :class:`~fptokens.Filename`
+    :param dry_run: Only return the planned moves, default: ``False``
+    :type dry_run: bool
+    :param jobs: Number of parallel rename threads, default: ``8``
+    :type jobs: int
+    :param batch_size: Number of renames per batch, default: ``1000``
+    :type batch_size: int
+    :param progress: Callable receiving ``(done, total)`` after each batch
+    :type progress: callable
+    :param journal: Journal file, default: ``.fptokens_migrate`` in the
+                    root location of ``src_template``
+    :type journal: str
+    :return: List of ``(source, destination)`` tuples
+    :rtype: list
+    """
+    missing = (set([token.name for token in dst_template.tokens] +
+                   list(dst_template.bound)) -
+               set([token.name for token in src_template.tokens] +
+                   list(src_template.bound)))
+    if missing:
+        raise TokenError('Data missing for tokens {0}'.format(
+            ', '.join(sorted(missing))))
+    if journal is None:
+        journal = os.path.join(str(src_template.root), '.fptokens_migrate')
+    header = {'migrate': [_template_key(src_template),
+                          _template_key(dst_template)]}
+    moved = set()
+    if os.path.exists(journal):
+        with open(journal) as entries:
+            if json.loads(next(entries, 'null')) != header:
+                raise ValueError('Journal {0} belongs to another '
+                                 'migration'.format(journal))
+            for entry in entries:
+                moved.add(os.path.normpath(json.loads(entry)[1]))
+    moves = []
+    for source, values in src_template.scan():
+        if os.path.normpath(source) in moved:
+            continue
+        destination = dst_template._render_path(values)
+        if os.path.normpath(source) != os.path.normpath(destination):
+            moves.append((source, destination))
+    sources = set([os.path.normpath(source) for source, _ in moves])
+    destinations = set()
+    for source, destination in moves:
+        destination = os.path.normpath(destination)
+        if (destination in destinations or destination in sources or
+                os.path.lexists(destination)):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                          destination)
+        destinations.add(destination)
+    if dry_run:
+        return moves
+    if not moves:
+        if os.path.exists(journal):
+            os.remove(journal)
+        return moves
+    with open(journal, 'a') as entries:
+        if not moved:
+            entries.seek(0, os.SEEK_END)
+            if not entries.tell():
+                entries.write(json.dumps(header) + '\n')
+        for move in moves:
+            entries.write(json.dumps(list(move)) + '\n')
+        entries.flush()
+        os.fsync(entries.fileno())
+    for dirpath in sorted(set([os.path.dirname(destination)
+                               for _, destination in moves])):
+        Path(dirpath).makedirs_p()
+    batches = [moves[idx:idx + batch_size]
+               for idx in range(0, len(moves), batch_size)]
+    pool = ThreadPool(max(1, jobs))
+    try:
+        done = 0
+        for count in pool.imap_unordered(_rename_batch, batches):
+            done += count
+            if progress is not None:
+                progress(done, len(moves))
+    finally:
+        pool.close()
+        pool.join()
+    os.remove(journal)
+    return moves
+
+
+def consume(iterable, consumer, jobs=4, maxsize=1024):
+    """
+    Call ``consumer`` with each item of ``iterable`` in ``jobs`` threads.
+    Items are handed over through a queue of at most ``maxsize`` items, so
+    ``iterable`` is only advanced as fast as the consumers keep up, for
+    example with the permutations of :meth:`~fptokens.Filename.resolve`.
+    The first exception raised by ``consumer`` stops the iteration and is
+    raised again once all threads have finished.
+
+    :param iterable: Items to consume
+    :type iterable: iterable
+    :param consumer: Callable receiving each item
+    :type consumer: callable
+    :param jobs: Number of consumer threads, default: ``4``
+    :type jobs: int
+    :param maxsize: Maximum number of queued items, default: ``1024``
+    :type maxsize: int
+    :return: Number of consumed items
+    :rtype: int
+    """
+    items = queue.Queue(maxsize=max(1, maxsize))
+    done = object()
+    errors = []
+    counts = []
+
+    def work():
+        count = 0
+        while True:
+            item = items.get()
+            if item is done:
+                counts.append(count)
+                return
+            if errors:
+                continue
+            try:
+                consumer(item)
+                count += 1
+            except Exception as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=work) for _ in range(max(1, jobs))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in iterable:
+            if errors:
+                break
+            items.put(item)
+    finally:
+        for _ in threads:
+            items.put(done)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return sum(counts)
@@ -1,5 +1,11 @@
 # fptokens tests
+import os
+import json
+import errno
+import time
 import pytest
+from glob import glob
+from itertools import count
 from path import Path
 import fptokens as fpt
 
@@ -131,3 +137,526 @@ def test_permutations(tmpdir, data, results):
             if perm.abspath.endswith(result):
                 match = True
         assert match == True
+
+
+def test_match(tmpdir):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    path = tmpdir / 'assets/1200px/black/untitled_1200px_black.jpg'
+    assert fp.match(path) == {'sizes': '1200px', 'colors': 'black'}
+    path = tmpdir / 'assets/1200px/black/untitled_2500px_black.jpg'
+    assert fp.match(path) is None
+    assert fp.match(tmpdir / 'assets/1200px/untitled_1200px_black.jpg') is None
+
+
+def test_scan(tmpdir, data, results):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    for perm in fp.resolve(**data):
+        perm.make()
+        perm.abspath.touch()
+    (tmpdir / 'assets/1200px/black/other.jpg').write('')
+    scanned = list(fp.scan())
+    assert len(scanned) == len(results)
+    for path, values in scanned:
+        assert fp.match(path) == values
+
+
+def test_migrate(tmpdir, data, results):
+    src = fpt.Filename(root=tmpdir,
+                       folders=['assets', '$sizes$', '$colors$'],
+                       base=['untitled', '$sizes$', '$colors$'])
+    dst = fpt.Filename(root=tmpdir,
+                       folders=['assets', '$colors$', '$sizes$'],
+                       base=['untitled', '$sizes$', '$colors$'])
+    src.parse()
+    dst.parse()
+    for perm in src.resolve(**data):
+        perm.make()
+        perm.abspath.touch()
+    moves = fpt.migrate(src, dst, dry_run=True)
+    assert len(moves) == len(results)
+    assert all([Path(source).exists() for source, _ in moves])
+    fpt.migrate(src, dst, jobs=2, batch_size=2)
+    assert not list(src.scan())
+    assert len(list(dst.scan())) == len(results)
+    assert fpt.migrate(src, dst) == []
+
+
+def test_migrate_resume(tmpdir, data, results):
+    src = fpt.Filename(root=tmpdir,
+                       folders=['assets', '$sizes$', '$colors$'],
+                       base=['asset'])
+    dst = fpt.Filename(root=tmpdir,
+                       folders=['assets', '$colors$', '$sizes$'],
+                       base=['asset'])
+    src.parse()
+    dst.parse()
+    for perm in src.resolve(**data):
+        perm.make()
+        perm.abspath.touch()
+    journal = tmpdir / 'journal'
+    moves = fpt.migrate(src, dst, dry_run=True, journal=journal)
+    assert len(moves) == len(results)
+    assert not journal.exists()
+    # simulate an interrupted run: plan journaled, only some files moved
+    header = {'migrate': [fpt._template_key(src), fpt._template_key(dst)]}
+    journal.write(''.join(['{0}\n'.format(json.dumps(entry))
+                           for entry in [header] + [list(move)
+                                                    for move in moves]]))
+    for source, destination in moves[:4]:
+        Path(destination).dirname().makedirs_p()
+        os.rename(source, destination)
+    with pytest.raises(ValueError):
+        fpt.migrate(dst, src, journal=journal)
+    assert len(fpt.migrate(src, dst, journal=journal)) == len(results) - 4
+    assert not journal.exists()
+    for source, destination in moves:
+        assert not Path(source).exists()
+        assert Path(destination).exists()
+    assert len(fpt.migrate(dst, src)) == len(results)
+    assert not (tmpdir / '.fptokens_migrate').exists()
+    for source, destination in moves:
+        assert Path(source).exists()
+
+
+def test_migrate_collision(tmpdir):
+    src = fpt.Filename(root=tmpdir, folders=['$sizes$', '$colors$'],
+                       base=['asset'])
+    dst = fpt.Filename(root=tmpdir, folders=['moved', '$colors$'],
+                       base=['asset'])
+    src.parse()
+    dst.parse()
+    for perm in src.resolve(sizes=['1200px', '2500px'], colors=['black']):
+        perm.make()
+        perm.abspath.touch()
+    with pytest.raises(OSError):
+        fpt.migrate(src, dst)
+    assert len(list(src.scan())) == 2
+    assert not (tmpdir / 'moved').exists()
+    dst = fpt.Filename(root=tmpdir, folders=['moved', '$sizes$', '$colors$'],
+                       base=['asset'])
+    dst.parse()
+    target = next(dst.resolve(sizes=['1200px'], colors=['black']))
+    target.make()
+    target.abspath.touch()
+    with pytest.raises(OSError):
+        fpt.migrate(src, dst)
+    assert len(list(src.scan())) == 2
+
+
+def test_migrate_invalid(tmpdir):
+    src = fpt.Filename(root=tmpdir, folders=['$sizes$'], base=['untitled'])
+    dst = fpt.Filename(root=tmpdir, folders=['$colors$'], base=['untitled'])
+    src.parse()
+    dst.parse()
+    with pytest.raises(fpt.TokenError):
+        fpt.migrate(src, dst)
+
+
+def test_template_set(tmpdir):
+    by_size = fpt.Filename(root=tmpdir,
+                           folders=['assets', '$sizes$', '$colors$'],
+                           base=['untitled', '$sizes$', '$colors$'])
+    by_color = fpt.Filename(root=tmpdir,
+                            folders=['assets', '$colors$'],
+                            base=['untitled', '$colors$'],
+                            extension='png')
+    fallback = fpt.Filename(root=tmpdir,
+                            folders=['assets', '$a$', '$b$'],
+                            base=['$c$'])
+    for template in (by_size, by_color, fallback):
+        template.parse()
+    templates = fpt.TemplateSet([by_size, by_color, fallback])
+    assert len(templates) == 3
+    path = tmpdir / 'assets/1200px/black/untitled_1200px_black.jpg'
+    assert templates.match(path) == (by_size,
+                                     {'sizes': '1200px', 'colors': 'black'})
+    path = tmpdir / 'assets/1200px/black/untitled_2500px_black.jpg'
+    assert templates.match(path) == (fallback,
+                                     {'a': '1200px', 'b': 'black',
+                                      'c': 'untitled_2500px_black'})
+    path = tmpdir / 'assets/black/untitled_black.png'
+    assert templates.match(path) == (by_color, {'colors': 'black'})
+    assert templates.match(tmpdir / 'assets/black/untitled_black.jpg') is None
+    assert templates.match(tmpdir / 'other/untitled_black.png') is None
+
+
+def test_template_set_token_names(tmpdir):
+    same = fpt.Filename(root=tmpdir, folders=['$a$', '$a$'], base=['$b$'])
+    other = fpt.Filename(root=tmpdir, folders=['$c$', '$d$'],
+                         base=['$d$', '$e$'])
+    for template in (same, other):
+        template.parse()
+    templates = fpt.TemplateSet([same, other])
+    assert templates.match(tmpdir / 'x/x/y.jpg') == (same,
+                                                     {'a': 'x', 'b': 'y'})
+    assert templates.match(tmpdir / 'x/z/y.jpg') is None
+    assert templates.match(tmpdir / 'x/z/z_y.jpg') == (other,
+                                                       {'c': 'x', 'd': 'z',
+                                                        'e': 'y'})
+    assert templates.match(tmpdir / 'x/z/w_y.jpg') is None
+
+
+_TICKS = count(1)
+
+
+def _touch_dirs(path):
+    # directory mtimes are not guaranteed to change within the timestamp
+    # granularity of the filesystem, move them past any earlier value so
+    # that the polling backend rescans them
+    mtime = time.time() + next(_TICKS)
+    for dirpath, _, _ in os.walk(str(path)):
+        os.utime(dirpath, (mtime, mtime))
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_existence_index(tmpdir, data, inotify):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    perms = list(fp.resolve(sizes=['1200px'], colors=['black', 'white']))
+    for perm in perms:
+        perm.make()
+        perm.abspath.touch()
+    index = fpt.ExistenceIndex(fp, inotify=inotify)
+    assert len(index) == 2
+    assert index.exists(sizes='1200px', colors='black')
+    assert not index.exists(sizes='2500px', colors='black')
+    assert len(index.missing(**data)) == 7
+    assert index.query(colors=['white']) == [{'sizes': '1200px',
+                                              'colors': 'white'}]
+    perms[0].abspath.remove()
+    perm = next(fp.resolve(sizes=['2500px'], colors=['silver']))
+    perm.make()
+    perm.abspath.touch()
+    (perm.dirname / 'other.jpg').touch()
+    _touch_dirs(tmpdir)
+    index.refresh()
+    assert len(index) == 2
+    assert not index.exists(sizes='1200px', colors='black')
+    assert index.exists(sizes='2500px', colors='silver')
+    (tmpdir / 'assets' / '2500px').remove()
+    _touch_dirs(tmpdir)
+    index.refresh()
+    assert index.query() == [{'sizes': '1200px', 'colors': 'white'}]
+    index.close()
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_existence_index_missing_root(tmpdir, inotify):
+    fp = fpt.Filename(root=tmpdir / 'late', folders=['$colors$'],
+                      base=['untitled'])
+    fp.parse()
+    index = fpt.ExistenceIndex(fp, inotify=inotify)
+    assert len(index) == 0
+    perm = next(fp.resolve(colors=['white']))
+    perm.make()
+    perm.abspath.touch()
+    index.refresh()
+    assert index.exists(colors='white')
+    (tmpdir / 'late').remove()
+    index.refresh()
+    assert len(index) == 0
+    index.close()
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_watch(tmpdir, inotify):
+    fp = fpt.Filename(root=tmpdir, folders=['$colors$'], base=['untitled'])
+    fp.parse()
+    with fp.watch(interval=0.01, inotify=inotify) as index:
+        assert len(index) == 0
+        perm = next(fp.resolve(colors=['white']))
+        perm.make()
+        perm.abspath.touch()
+        _touch_dirs(tmpdir)
+        deadline = time.time() + 5
+        while not index.exists(colors='white') and time.time() < deadline:
+            time.sleep(0.01)
+        assert index.query() == [{'colors': 'white'}]
+
+
+def test_roots(tmpdir):
+    fp = fpt.Filename(root=[tmpdir / 'a', (tmpdir / 'b', 2)],
+                      folders=['$colors$'], base=['untitled'])
+    fp.parse()
+    assert fp.root == tmpdir / 'a'
+    assert fp.roots == [(tmpdir / 'a', 1.0), (tmpdir / 'b', 2.0)]
+    with pytest.raises(ValueError):
+        fp.roots = [(tmpdir / 'a', 0)]
+    with pytest.raises(fpt.TokenError):
+        fp.locate()
+
+
+def test_locate(tmpdir):
+    roots = [str(tmpdir / str(idx)) for idx in range(4)]
+    fp = fpt.Filename(root=roots, folders=['$shots$'], base=['untitled'])
+    fp.parse()
+    shots = [str(shot) for shot in range(2000)]
+    placed = dict([(shot, fp.locate(shots=shot)) for shot in shots])
+    counts = [list(placed.values()).count(root) for root in roots]
+    assert all([400 < count < 600 for count in counts])
+    for perm in fp.resolve(shots=shots[:10]):
+        shot = perm.folders[0]
+        assert perm.root == placed[shot]
+        assert fp.match(perm.abspath) == {'shots': shot}
+        perm.make()
+        perm.abspath.touch()
+    assert len(list(fp.scan())) == 10
+    fp.roots = roots + [str(tmpdir / '4')]
+    moved = [shot for shot in shots if fp.locate(shots=shot) != placed[shot]]
+    assert all([fp.locate(shots=shot) == tmpdir / '4' for shot in moved])
+    assert 300 < len(moved) < 500
+    literal = fpt.Filename(root=roots, folders=['shots', 'sh010'],
+                           base=['untitled'])
+    literal.parse()
+    assert literal.dirname == literal.locate() / 'shots/sh010'
+    assert literal.abspath.startswith(literal.locate())
+
+
+def test_permutations_duplicates():
+    # a fixed root keeps the Bloom filter hashes, and the test, deterministic
+    fp = fpt.Filename(root='', folders=['$sizes$'], base=['$colors$'])
+    fp.parse()
+    data = {'sizes': ['1200px', '2500px'],
+            'colors': ['black', 'Black', 'black']}
+    assert len(list(fp.resolve(**data))) == 6
+    with pytest.raises(fpt.TokenError):
+        list(fp.resolve(on_duplicate='error', **data))
+    with pytest.raises(ValueError):
+        list(fp.resolve(on_duplicate='ignore', **data))
+    assert len(list(fp.resolve(on_duplicate='skip', **data))) == 4
+    assert len(list(fp.resolve(on_duplicate='skip', case_sensitive=False,
+                               **data))) == 2
+    assert len(list(fp.resolve(on_duplicate='skip', max_exact=1,
+                               **data))) == 4
+
+
+def test_path_set():
+    paths = fpt._PathSet(max_exact=100, error_rate=0.01, capacity=2000)
+    assert not any([paths.add(str(idx)) for idx in range(100)])
+    assert sum([paths.add(str(idx)) for idx in range(100, 2000)]) < 100
+    assert paths._exact is None
+    assert all([paths.add(str(idx)) for idx in range(2000)])
+
+
+def test_validate(tmpdir, data):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    fp.validate(**data)
+    with pytest.raises(fpt.TokenError):
+        fp.validate(sizes=['1200px'])
+    with pytest.raises(fpt.TokenError) as error:
+        fp.validate(sizes=['1200px', '..', ''], colors=['black', 'a/b'])
+    assert "'..' is not a folder name" in str(error.value)
+    assert 'sizes: empty value' in str(error.value)
+    assert "'a/b' contains '/'" in str(error.value)
+    with pytest.raises(fpt.TokenError) as error:
+        fp.validate(sizes=['1200px', 'x' * 240], colors=['black'])
+    assert 'basename of' in str(error.value)
+    assert "colors='black'" in str(error.value)
+    with pytest.raises(fpt.TokenError) as error:
+        fp.validate(path_max=60, **data)
+    assert 'path of' in str(error.value)
+    with pytest.raises(fpt.TokenError):
+        list(fp.resolve(validate=True, sizes=['1200px'], colors=['a/b']))
+    assert len(list(fp.resolve(sizes=['1200px'], colors=['a/b']))) == 1
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'reflink', 'copy'])
+def test_materialize(tmpdir, data, results, mode):
+    source = tmpdir / 'source.jpg'
+    source.write('content')
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    created = []
+    assert fp.materialize(source, mode=mode, jobs=2, batch_size=2,
+                          callback=created.append, **data) == len(results)
+    assert len(created) == len(results)
+    for path in created:
+        assert open(path).read() == 'content'
+        assert Path(path).samefile(source) == (mode == 'hardlink')
+    assert fp.materialize(source, mode=mode, **data) == 0
+    with pytest.raises(ValueError):
+        fp.materialize(source, mode='symlink', **data)
+
+
+def test_materialize_cross_device(tmpdir, data, results, monkeypatch):
+    source = tmpdir / 'source.jpg'
+    source.write('content')
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+
+    def link(*args, **kwargs):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, 'link', link)
+    assert fp.materialize(source, sizes=iter(data['sizes']),
+                          colors=data['colors']) == len(results)
+    for path, _ in fp.scan():
+        assert open(path).read() == 'content'
+        assert not Path(path).samefile(source)
+
+
+def test_bind(tmpdir, data, results):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    bound = fp.bind(colors='black')
+    assert [token.name for token in bound.tokens] == ['sizes']
+    assert bound.bound == {'colors': 'black'}
+    assert bound.folders[1] is fp.folders[1]
+    assert len(fp.tokens) == 2
+    with pytest.raises(fpt.TokenError):
+        bound.bind(colors='white')
+    perms = list(bound.resolve(sizes=data['sizes']))
+    assert len(perms) == 3
+    assert all([perm.abspath.endswith('_black.jpg') for perm in perms])
+    final = bound.bind(sizes='1200px')
+    assert not final.tokens
+    assert final.abspath.endswith(results[0])
+    for perm in fp.resolve(**data):
+        perm.make()
+        perm.abspath.touch()
+    assert sorted(glob(bound.to_glob())) == \
+        sorted([path for path, _ in bound.scan()])
+    assert len(list(bound.scan())) == 3
+    assert all([values['colors'] == 'black' for _, values in bound.scan()])
+    regex = bound.to_regex()
+    assert regex.match(tmpdir / results[0]) == {'sizes': '1200px'}
+    assert regex.match(tmpdir / results[3]) is None
+    digits = fpt.Filename(root=tmpdir, folders=['$2d$'], base=['$3d$'])
+    digits.parse()
+    assert digits.to_regex().match(tmpdir / 'a/b.jpg') == {'2d': 'a',
+                                                          '3d': 'b'}
+
+
+def test_bind_roots(tmpdir):
+    fp = fpt.Filename(root=[tmpdir / 'a', tmpdir / 'b', tmpdir / 'c'],
+                      folders=['$sizes$', '$colors$'], base=['untitled'])
+    fp.parse()
+    for color in ('black', 'white', 'silver', 'gold'):
+        bound = fp.bind(colors=color)
+        assert bound.locate(sizes='1200px') == \
+            fp.locate(sizes='1200px', colors=color)
+        assert bound.bind(sizes='1200px').root == \
+            fp.locate(sizes='1200px', colors=color)
+    for perm in fp.resolve(sizes=['1200px', '2500px'],
+                           colors=['black', 'white', 'silver', 'gold']):
+        perm.make()
+        perm.abspath.touch()
+    bound = fp.bind(sizes='1200px')
+    with pytest.raises(ValueError):
+        bound.to_glob()
+    globs = bound.to_globs()
+    assert len(globs) == 3
+    found = sorted([path for pattern in globs for path in glob(pattern)])
+    assert len(found) == 4
+    assert found == sorted([path for path, _ in bound.scan()])
+    assert all([bound.to_regex().match(path) is not None for path in found])
+
+
+def test_permutations_lazy(tmpdir, data, results):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    calls = []
+
+    def colors():
+        calls.append(1)
+        return iter(data['colors'])
+
+    streamed = (size for size in data['sizes'])
+    permutations = fp.resolve(sizes=streamed, colors=colors)
+    first = next(permutations)
+    assert first.abspath.endswith(results[0])
+    assert len(calls) == 1
+    assert len(list(permutations)) == len(results) - 1
+    assert len(calls) == len(data['sizes'])
+    assert [perm.abspath for perm in fp.resolve(sizes=iter(data['sizes']),
+                                                colors=data['colors'])] == \
+        [perm.abspath for perm in fp.resolve(sizes=data['sizes'],
+                                             colors=colors)]
+    with pytest.raises(fpt.TokenError):
+        list(fp.resolve(sizes=iter(data['sizes']),
+                        colors=iter(data['colors'])))
+    with pytest.raises(fpt.TokenError):
+        list(fp.resolve(validate=True, sizes=iter(data['sizes']),
+                        colors=colors))
+    assert len(list(fp.resolve(validate=True, on_duplicate='error',
+                               sizes=data['sizes'], colors=colors))) == 9
+
+
+def test_consume(data, results):
+    fp = fpt.Filename(root='',
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    paths = []
+    assert fpt.consume(fp.resolve(**data),
+                       lambda perm: paths.append(perm.abspath),
+                       jobs=3, maxsize=2) == len(results)
+    assert sorted(paths) == sorted([perm.abspath
+                                    for perm in fp.resolve(**data)])
+
+    def fail(item):
+        raise RuntimeError(item)
+
+    with pytest.raises(RuntimeError):
+        fpt.consume(iter(range(100000)), fail, jobs=2, maxsize=4)
+
+
+def test_permutations_duplicates_streamed(tmpdir):
+    fp = fpt.Filename(root=tmpdir, folders=['$shots$'], base=['$frames$'])
+    fp.parse()
+    frames = [str(frame) for frame in range(100)]
+    permutations = fp.resolve(on_duplicate='skip', max_exact=100,
+                              shots=(str(shot) for shot in range(200)),
+                              frames=lambda: frames)
+    assert len(list(permutations)) > 19950
+
+
+def test_existence_index_watch_limit(tmpdir, data, monkeypatch):
+    fp = fpt.Filename(root=tmpdir,
+                      folders=['assets', '$sizes$', '$colors$'],
+                      base=['untitled', '$sizes$', '$colors$'])
+    fp.parse()
+    for perm in fp.resolve(sizes=data['sizes'][:2], colors=data['colors'][:2]):
+        perm.make()
+        perm.abspath.touch()
+    add = fpt._Inotify.add
+    calls = []
+
+    def limited_add(self, path):
+        calls.append(path)
+        if len(calls) >= 5:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+        return add(self, path)
+
+    monkeypatch.setattr(fpt._Inotify, 'add', limited_add)
+    with pytest.warns(UserWarning):
+        index = fpt.ExistenceIndex(fp)
+    assert index.backend == 'inotify'
+    assert len(index) == 4
+    perm = next(fp.resolve(sizes=data['sizes'][1:2],
+                           colors=data['colors'][2:]))
+    perm.make()
+    perm.abspath.touch()
+    _touch_dirs(tmpdir)
+    index.refresh()
+    assert index.exists(sizes=data['sizes'][1], colors=data['colors'][2])
+    index.close()